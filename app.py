@@ -1,11 +1,27 @@
 import streamlit as st
-import requests
+import httpx
 import json
 import io
 
 # --- Configuration ---
 # Ensure this URL matches where your FastAPI server is running
-FASTAPI_ENDPOINT_URL = "http://127.0.0.1:8000/analyze_invoices"
+FASTAPI_BASE_URL = "http://127.0.0.1:8000"
+FASTAPI_ENDPOINT_PATH = "/analyze_invoices/"
+FASTAPI_ENDPOINT_URL = FASTAPI_BASE_URL + FASTAPI_ENDPOINT_PATH
+
+
+@st.cache_resource
+def get_api_client() -> httpx.Client:
+    """
+    Returns a long-lived HTTP client shared across Streamlit reruns and sessions,
+    so connections to the FastAPI backend are pooled and kept alive between analyses.
+    """
+    return httpx.Client(
+        base_url=FASTAPI_BASE_URL,
+        timeout=httpx.Timeout(600.0, connect=5.0),  # LLM analysis of a large batch can take minutes
+        limits=httpx.Limits(max_keepalive_connections=4)
+    )
+
 
 st.set_page_config(
     page_title="Invoice Reimbursement Analyzer",
@@ -53,53 +69,78 @@ if st.button("Analyze Invoices", use_container_width=True, type="primary"):
     elif invoice_zip is None:
         st.error("Please upload the Employee Invoices ZIP file.")
     else:
-        with st.spinner("Analyzing invoices... This may take a moment depending on the number of invoices and policy length."):
-            try:
-                # Prepare files for FastAPI multipart/form-data request
-                files = {
-                    "policy_file": (policy_file.name, policy_file.getvalue(), "application/pdf"),
-                    "invoice_zip": (invoice_zip.name, invoice_zip.getvalue(), "application/zip")
-                }
-
-                # Make the POST request to the FastAPI endpoint
-                response = requests.post(FASTAPI_ENDPOINT_URL, files=files)
-
+        progress = st.status("Analyzing invoices... Results appear below as each invoice is analyzed.", expanded=False)
+        results_container = st.container()
+        try:
+            # Prepare files for FastAPI multipart/form-data request.
+            # Pass the uploaded file handles directly instead of copying their bytes with getvalue().
+            policy_file.seek(0)
+            invoice_zip.seek(0)
+            files = {
+                "policy_file": (policy_file.name, policy_file, "application/pdf"),
+                "invoice_zip": (invoice_zip.name, invoice_zip, "application/zip")
+            }
+
+            # Make the POST request to the FastAPI endpoint and read the NDJSON stream as it arrives
+            with get_api_client().stream("POST", FASTAPI_ENDPOINT_PATH, files=files) as response:
                 if response.status_code == 200:
-                    result = response.json()
-                    st.success("Analysis Complete!")
-
                     # --- Display Results ---
-                    st.subheader("3. Analysis Results")
-
-                    if "invoice_analyses" in result and result["invoice_analyses"]:
-                        for invoice_data in result["invoice_analyses"]:
-                            invoice_id = invoice_data.get("Invoice identifier", "N/A")
-                            status = invoice_data.get("Reimbursement Status", "N/A")
-                            reimbursable_amount = invoice_data.get("Reimbursable Amount", "N/A")
-                            reason = invoice_data.get("Reason", "No reason provided.")
-
-                            # Use st.expander for a collapsible view of each invoice's details
-                            with st.expander(f"**Invoice: `{invoice_id}` - Status: `{status}`**"):
-                                st.markdown(f"**Reimbursement Status:** <span style='font-size: 1.1em; color: {'green' if status == 'Fully Reimbursed' else ('orange' if status == 'Partially Reimbursed' else 'red')}; font-weight: bold;'>{status}</span>", unsafe_allow_html=True)
-                                st.markdown(f"**Reimbursable Amount:** **${reimbursable_amount}**")
-                                st.markdown(f"**Reason:** {reason}")
-                                st.markdown("---") # Separator for clarity
-
+                    results_container.subheader("3. Analysis Results")
+                    analyzed_count = 0
+                    overall_status = None
+
+                    for line in response.iter_lines():
+                        if not line.strip():
+                            continue
+                        invoice_data = json.loads(line)
+
+                        if "overall_status" in invoice_data:
+                            overall_status = invoice_data["overall_status"]
+                            continue
+                        if "detail" in invoice_data:
+                            results_container.error(f"API Error: {invoice_data['detail']}")
+                            continue
+
+                        invoice_id = invoice_data.get("Invoice identifier", "N/A")
+                        status = invoice_data.get("Reimbursement Status", "N/A")
+                        reimbursable_amount = invoice_data.get("Reimbursable Amount", "N/A")
+                        reason = invoice_data.get("Reason", "No reason provided.")
+
+                        # Use st.expander for a collapsible view of each invoice's details
+                        with results_container.expander(f"**Invoice: `{invoice_id}` - Status: `{status}`**"):
+                            st.markdown(f"**Reimbursement Status:** <span style='font-size: 1.1em; color: {'green' if status == 'Fully Reimbursed' else ('orange' if status == 'Partially Reimbursed' else 'red')}; font-weight: bold;'>{status}</span>", unsafe_allow_html=True)
+                            st.markdown(f"**Reimbursable Amount:** **${reimbursable_amount}**")
+                            st.markdown(f"**Reason:** {reason}")
+                            st.markdown("---") # Separator for clarity
+
+                        analyzed_count += 1
+                        progress.update(label=f"Analyzing invoices... {analyzed_count} done.")
+
+                    if overall_status is not None:
+                        progress.update(label=f"Analysis Complete! Overall status: {overall_status}", state="complete")
                     else:
-                        st.warning("No invoice analysis results returned from the API.")
+                        progress.update(label="Analysis ended before all invoices were processed.", state="error")
+                    if analyzed_count == 0:
+                        results_container.warning("No invoice analysis results returned from the API.")
 
-                elif response.status_code == 400:
-                    st.error(f"Input Error: {response.json().get('detail', 'Bad Request')}")
                 else:
-                    st.error(f"API Error: {response.status_code} - {response.text}")
-
-            except requests.exceptions.ConnectionError:
-                st.error(f"Could not connect to the FastAPI server at {FASTAPI_ENDPOINT_URL}. "
-                         "Please ensure the backend API is running.")
-            except json.JSONDecodeError:
-                st.error("Received an invalid JSON response from the API. Please check the backend logs.")
-            except Exception as e:
-                st.error(f"An unexpected error occurred: {e}")
+                    response.read()
+                    progress.update(label="Analysis failed.", state="error")
+                    if response.status_code == 400:
+                        st.error(f"Input Error: {response.json().get('detail', 'Bad Request')}")
+                    else:
+                        st.error(f"API Error: {response.status_code} - {response.text}")
+
+        except httpx.ConnectError:
+            progress.update(label="Analysis failed.", state="error")
+            st.error(f"Could not connect to the FastAPI server at {FASTAPI_ENDPOINT_URL}. "
+                     "Please ensure the backend API is running.")
+        except json.JSONDecodeError:
+            progress.update(label="Analysis failed.", state="error")
+            st.error("Received an invalid JSON response from the API. Please check the backend logs.")
+        except Exception as e:
+            progress.update(label="Analysis failed.", state="error")
+            st.error(f"An unexpected error occurred: {e}")
 
 st.markdown("---")
 st.caption("Powered by FastAPI, Streamlit, and Google Gemini AI.")
@@ -0,0 +1,153 @@
+import os
+import time
+import json
+import math
+import sqlite3
+import asyncio
+from typing import Any, Dict, List, Optional
+
+# --- Configuration ---
+# Location of the SQLite database backing the LLM response cache.
+# Stored on disk so cached analyses survive server restarts.
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3")
+
+
+class LLMCache:
+    """
+    A small persistent key/value cache for LLM responses, backed by SQLite.
+    Blocking SQLite calls are run in a worker thread so the event loop is never stalled.
+    """
+
+    def __init__(self, db_path: str = LLM_CACHE_PATH):
+        self.db_path = db_path
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def _get_sync(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at is not None and expires_at < time.time():
+                conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                return None
+            return json.loads(value)
+
+    def _set_sync(self, key: str, value: Dict[str, Any], ttl: Optional[int]) -> None:
+        expires_at = time.time() + ttl if ttl else None
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), expires_at)
+            )
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Looks up a cached LLM response.
+        Args:
+            key: The cache key.
+        Returns:
+            The cached dictionary, or None if missing or expired.
+        """
+        return await asyncio.to_thread(self._get_sync, key)
+
+    async def set(self, key: str, value: Dict[str, Any], ttl: Optional[int] = None) -> None:
+        """
+        Stores an LLM response in the cache.
+        Args:
+            key: The cache key.
+            value: The JSON-serializable dictionary to store.
+            ttl: Time to live in seconds. None means the entry never expires.
+        """
+        await asyncio.to_thread(self._set_sync, key, value, ttl)
+
+
+class SemanticCache:
+    """
+    A persistent nearest-neighbour cache for LLM responses, backed by SQLite.
+    Entries are grouped by a namespace (e.g. a policy hash) and matched on the cosine
+    similarity of their embeddings, so near-duplicate invoices (whitespace or OCR noise)
+    can reuse a previous analysis. Search is a brute-force scan over the namespace,
+    which is fast enough for the number of invoices a single policy typically sees.
+    """
+
+    def __init__(self, db_path: str = LLM_CACHE_PATH):
+        self.db_path = db_path
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS semantic_cache ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, namespace TEXT NOT NULL, fingerprint TEXT NOT NULL, "
+                "embedding TEXT NOT NULL, value TEXT NOT NULL, expires_at REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_semantic_cache_lookup ON semantic_cache (namespace, fingerprint)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    @staticmethod
+    def _cosine_similarity(a: List[float], b: List[float]) -> float:
+        dot = sum(x * y for x, y in zip(a, b))
+        norm_a = math.sqrt(sum(x * x for x in a))
+        norm_b = math.sqrt(sum(y * y for y in b))
+        if not norm_a or not norm_b:
+            return 0.0
+        return dot / (norm_a * norm_b)
+
+    def _search_sync(self, namespace: str, fingerprint: str, embedding: List[float],
+                     threshold: float) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM semantic_cache WHERE expires_at IS NOT NULL AND expires_at < ?", (time.time(),))
+            rows = conn.execute(
+                "SELECT embedding, value FROM semantic_cache WHERE namespace = ? AND fingerprint = ?",
+                (namespace, fingerprint)
+            ).fetchall()
+        best_score, best_value = threshold, None
+        for stored_embedding, value in rows:
+            score = self._cosine_similarity(embedding, json.loads(stored_embedding))
+            if score >= best_score:
+                best_score, best_value = score, value
+        return json.loads(best_value) if best_value is not None else None
+
+    def _add_sync(self, namespace: str, fingerprint: str, embedding: List[float],
+                  value: Dict[str, Any], ttl: Optional[int]) -> None:
+        expires_at = time.time() + ttl if ttl else None
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO semantic_cache (namespace, fingerprint, embedding, value, expires_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (namespace, fingerprint, json.dumps(embedding), json.dumps(value), expires_at)
+            )
+
+    async def search(self, namespace: str, fingerprint: str, embedding: List[float],
+                     threshold: float) -> Optional[Dict[str, Any]]:
+        """
+        Finds the most similar cached LLM response.
+        Args:
+            namespace: Only entries stored under this namespace are considered.
+            fingerprint: Only entries with this exact fingerprint are considered (e.g. the amounts on an invoice).
+            embedding: The embedding of the query text.
+            threshold: Minimum cosine similarity for a match.
+        Returns:
+            The cached dictionary of the closest match, or None if nothing is similar enough.
+        """
+        return await asyncio.to_thread(self._search_sync, namespace, fingerprint, embedding, threshold)
+
+    async def add(self, namespace: str, fingerprint: str, embedding: List[float],
+                  value: Dict[str, Any], ttl: Optional[int] = None) -> None:
+        """
+        Stores an LLM response alongside the embedding of the text that produced it.
+        Args:
+            namespace: The namespace to store the entry under.
+            fingerprint: An exact-match fingerprint that must also agree on lookup.
+            embedding: The embedding of the source text.
+            value: The JSON-serializable dictionary to store.
+            ttl: Time to live in seconds. None means the entry never expires.
+        """
+        await asyncio.to_thread(self._add_sync, namespace, fingerprint, embedding, value, ttl)
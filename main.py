@@ -1,19 +1,29 @@
 import os
+import asyncio
 import zipfile
-import shutil
+import io
 import json
-import tempfile
-from typing import List, Dict, Any
+import hashlib
+import re
+import datetime
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Tuple, Optional, AsyncIterator, BinaryIO
 
 from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import StreamingResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-import PyPDF2  # For PDF text extraction
+import orjson  # Fast JSON parsing/serialization
+import fitz  # PyMuPDF, for fast PDF text extraction
+import PyPDF2  # Fallback PDF text extraction
 import google.generativeai as genai  # For Google Gemini LLM
+from google.generativeai import caching  # For Gemini context caching
 from dotenv import load_dotenv  # Import load_dotenv
 import uvicorn  # Import uvicorn to allow running as a script
 
-from pydantic import BaseModel, Field
+from llm_cache import LLMCache, SemanticCache  # Persistent caches for LLM responses
+
+from pydantic import BaseModel, ConfigDict, Field
 from enum import Enum
 
 # --- Configuration ---
@@ -30,10 +40,43 @@ genai.configure(api_key=API_KEY)
 # If more complex reasoning or larger context windows are needed, consider 'gemini-1.5-pro-latest'.
 GEMINI_MODEL = "gemini-1.5-flash"
 
+# Maximum number of concurrent Gemini calls per worker process, to stay within Gemini rate limits.
+MAX_CONCURRENT_LLM_CALLS = int(os.getenv("GEMINI_MAX_PARALLEL", "8"))
+LLM_SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENT_LLM_CALLS)
+
+# PDF text extraction is CPU-bound, so it is spread across processes to bypass the GIL.
+PDF_POOL = ProcessPoolExecutor(max_workers=os.cpu_count())
+
+# Bump this whenever SYSTEM_PROMPT or the user prompt template changes, so stale cached analyses are invalidated.
+PROMPT_VERSION = "v2"
+# How long cached LLM analyses are kept (7 days).
+LLM_CACHE_TTL_SECONDS = 604800
+llm_cache = LLMCache()
+
+# Near-duplicate invoices (whitespace/OCR noise) reuse a cached analysis when their embeddings are this similar.
+EMBEDDING_MODEL = "models/text-embedding-004"
+SEMANTIC_CACHE_THRESHOLD = 0.92
+semantic_cache = SemanticCache()
+
+# Context caching: the policy and system prompt are uploaded once per batch and referenced by every invoice call.
+# Caching requires an explicitly versioned model, and Gemini rejects caches below a minimum token count,
+# so shorter policies fall back to inlining the policy in each prompt.
+GEMINI_CACHE_MODEL = "models/gemini-1.5-flash-002"
+POLICY_CACHE_MIN_TOKENS = 32768
+POLICY_CACHE_TTL = datetime.timedelta(hours=1)
+
+# Invoices that need an LLM call are sent in groups of up to this many per request, to cut per-call overhead.
+INVOICE_BATCH_SIZE = 5
+# Upper bound on the prompt size of one batch (~4 characters per token), well inside the model's context window.
+BATCH_MAX_PROMPT_CHARS = 400000
+# Keys every analysis returned by the LLM must contain.
+ANALYSIS_KEYS = {"Invoice identifier", "Reimbursement Status", "Reimbursable Amount", "Reason"}
+
 app = FastAPI(
     title="Invoice Reimbursement Analysis API",
     description="Automates checking employee expense invoices against HR policy using LLM.",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # --- CORS Middleware ---
@@ -88,80 +131,360 @@ For each invoice, provide a JSON object with the following structure. Ensure all
 """
 
 
+# The model is built once and shared by all requests, so its configuration and gRPC channel are reused.
+# The system prompt is set as the model's system instruction rather than being sent as a conversation turn.
+GENERATION_CONFIG = {"response_mime_type": "application/json"}  # Request JSON output
+MODEL = genai.GenerativeModel(GEMINI_MODEL, system_instruction=SYSTEM_PROMPT, generation_config=GENERATION_CONFIG)
+
+
+# Policy text is compacted before use (whitespace runs, repeated headers/footers and table-of-contents lines
+# are dropped). Bump this whenever compact_policy_text changes, so cached policy text is re-extracted.
+POLICY_TEXT_VERSION = "v1"
+WHITESPACE_RUN = re.compile(r"[ \t\u00a0]+")
+TOC_ENTRY = re.compile(r"(\.\s*){4,}\d+$")  # e.g. "3.2 Meals ........ 7"
+
+# Regex rules that decline obviously non-reimbursable invoices (e.g. categories the policy explicitly excludes)
+# without an LLM call. Only add rules that hold under every policy this deployment analyzes.
+DECLINE_RULES_PATH = os.getenv("DECLINE_RULES_PATH", "decline_rules.json")
+
+
 # --- Helper Functions ---
 
-def extract_text_from_pdf(pdf_path: str) -> str:
+def extract_pages_from_pdf(pdf_name: str, pdf_bytes: bytes) -> List[str]:
+    """
+    Extracts the text of each page of an in-memory PDF file.
+    Uses PyMuPDF (C-backed, much faster than pure-Python parsing) and falls back to PyPDF2
+    for files PyMuPDF cannot handle.
+    Args:
+        pdf_name: The filename of the PDF, used in error messages.
+        pdf_bytes: The raw contents of the PDF file.
+    Returns:
+        The extracted text of each page.
+    Raises:
+        Exception: If PDF cannot be read or text extraction fails.
+    """
+    try:
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            return [page.get_text("text") for page in doc]
+    except Exception as fitz_error:
+        print(f"Warning: PyMuPDF failed to read {pdf_name}, falling back to PyPDF2: {fitz_error}")
+
+    try:
+        reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes))
+        return [page.extract_text() or "" for page in reader.pages]
+    except Exception as e:
+        raise Exception(f"Failed to extract text from PDF {pdf_name}: {e}")
+
+
+def extract_text_from_pdf(pdf_name: str, pdf_bytes: bytes) -> str:
     """
-    Extracts text content from a PDF file.
+    Extracts text content from an in-memory PDF file.
     Args:
-        pdf_path: The path to the PDF file.
+        pdf_name: The filename of the PDF, used in error messages.
+        pdf_bytes: The raw contents of the PDF file.
     Returns:
         The extracted text content as a string.
     Raises:
         Exception: If PDF cannot be read or text extraction fails.
     """
-    text = ""
+    return "\n".join(extract_pages_from_pdf(pdf_name, pdf_bytes))
+
+
+def compact_policy_text(pages: List[str]) -> str:
+    """
+    Strips content that costs tokens without carrying policy meaning: runs of whitespace, blank lines,
+    table-of-contents entries and headers/footers repeated on most pages (e.g. "Company Confidential", "Page 3 of 12").
+    Args:
+        pages: The extracted text of each page of the policy PDF.
+    Returns:
+        The compacted policy text, one line per non-empty line of the original.
+    """
+    page_lines = [
+        [line for line in (WHITESPACE_RUN.sub(" ", raw_line).strip() for raw_line in page.splitlines()) if line]
+        for page in pages
+    ]
+
+    # Headers/footers: lines (ignoring numbers, so page numbers still match) on more than half of the pages
+    repeated_lines = set()
+    if len(page_lines) >= 3:
+        line_page_counts = Counter(key for lines in page_lines for key in {re.sub(r"\d+", "#", line) for line in lines})
+        repeated_lines = {key for key, count in line_page_counts.items() if count > len(page_lines) / 2}
+
+    return "\n".join(
+        line
+        for lines in page_lines
+        for line in lines
+        if re.sub(r"\d+", "#", line) not in repeated_lines and not TOC_ENTRY.search(line)
+    )
+
+
+def read_invoices_from_zip(zip_file: BinaryIO) -> List[Tuple[str, bytes]]:
+    """
+    Reads all invoice PDFs out of a ZIP archive.
+    Args:
+        zip_file: A seekable binary file object holding the ZIP archive (e.g. the uploaded file itself).
+    Returns:
+        A list of (filename, PDF bytes) tuples.
+    Raises:
+        zipfile.BadZipFile: If the archive cannot be read.
+    """
+    invoice_files = []
+    with zipfile.ZipFile(zip_file) as zip_ref:
+        for member in zip_ref.namelist():
+            # Only process PDF files within the zip
+            if member.lower().endswith(".pdf") and not member.startswith(
+                    '__MACOSX/'):  # Ignore macOS specific files
+                invoice_files.append((os.path.basename(member), zip_ref.read(member)))
+    return invoice_files
+
+
+def load_decline_rules(rules_path: str) -> List[Tuple[re.Pattern, str]]:
+    """
+    Loads the regex rules used to decline obviously non-reimbursable invoices without an LLM call.
+    The file is a JSON list of {"pattern": "<regex>", "reason": "<explanation>"} objects; patterns are case-insensitive.
+    Args:
+        rules_path: The path to the JSON rules file.
+    Returns:
+        A list of (compiled pattern, reason) tuples. Empty if the file does not exist.
+    Raises:
+        ValueError: If the file is not a valid rules list or a pattern does not compile.
+    """
+    if not os.path.exists(rules_path):
+        return []
+    try:
+        with open(rules_path, "r", encoding="utf-8") as file:
+            return [(re.compile(rule["pattern"], re.IGNORECASE), rule["reason"]) for rule in json.load(file)]
+    except (json.JSONDecodeError, KeyError, TypeError, re.error) as e:
+        raise ValueError(f"Invalid decline rules file {rules_path}: {e}")
+
+
+DECLINE_RULES = load_decline_rules(DECLINE_RULES_PATH)
+
+
+def match_decline_rule(invoice_text: str) -> Optional[str]:
+    """
+    Checks an invoice against the decline rules.
+    Args:
+        invoice_text: The extracted text of the invoice.
+    Returns:
+        The reason of the first matching rule, or None if no rule matches.
+    """
+    for pattern, reason in DECLINE_RULES:
+        if pattern.search(invoice_text):
+            return reason
+    return None
+
+
+def _invoice_fingerprint(invoice_text: str) -> str:
+    """
+    Builds an exact-match fingerprint from the numbers on an invoice (amounts, dates, invoice numbers).
+    Semantic cache hits must agree on this, so two invoices from the same template but with
+    different amounts never share an analysis.
+    Args:
+        invoice_text: The extracted text of the invoice.
+    Returns:
+        A SHA-256 hex digest of the sorted numeric tokens.
+    """
+    numbers = sorted(re.findall(r"\d+(?:[.,]\d+)*", invoice_text))
+    return hashlib.sha256(" ".join(numbers).encode()).hexdigest()
+
+
+async def embed_text(text: str) -> Optional[List[float]]:
+    """
+    Embeds text for the semantic cache.
+    Args:
+        text: The text to embed.
+    Returns:
+        The embedding vector, or None if the embedding call fails (the caller then skips the semantic cache).
+    """
     try:
-        with open(pdf_path, "rb") as file:
-            reader = PyPDF2.PdfReader(file)
-            for page_num in range(len(reader.pages)):
-                text += reader.pages[page_num].extract_text() or ""
-        return text
+        result = await genai.embed_content_async(model=EMBEDDING_MODEL, content=text)
+        return result["embedding"]
     except Exception as e:
-        raise Exception(f"Failed to extract text from PDF {pdf_path}: {e}")
+        print(f"Warning: Failed to embed text for semantic cache: {e}")
+        return None
+
+
+async def get_policy_text(policy_filename: str, policy_bytes: bytes, policy_hash: str) -> str:
+    """
+    Extracts and compacts the text of the HR policy PDF, memoized on disk by the hash of the PDF contents.
+    The same policy is typically reused across many runs, so repeat runs skip the PDF parsing.
+    Args:
+        policy_filename: The filename of the policy PDF, used in error messages.
+        policy_bytes: The raw contents of the policy PDF.
+        policy_hash: The SHA-256 hex digest of policy_bytes.
+    Returns:
+        The compacted policy text.
+    """
+    cache_key = f"policy-text:{POLICY_TEXT_VERSION}:{policy_hash}"
+    cached_policy = await llm_cache.get(cache_key)
+    if cached_policy is not None:
+        return cached_policy["policy_text"]
+
+    policy_pages = await asyncio.get_running_loop().run_in_executor(
+        PDF_POOL, extract_pages_from_pdf, policy_filename, policy_bytes
+    )
+    policy_text = compact_policy_text(policy_pages)
+    if policy_text.strip():
+        await llm_cache.set(cache_key, {"policy_text": policy_text}, ttl=LLM_CACHE_TTL_SECONDS)
+    return policy_text
 
 
-async def analyze_invoice_with_llm(policy_text: str, invoice_filename: str, invoice_text: str) -> Dict[str, Any]:
+async def get_policy_cache(policy_text: str, policy_hash: str) -> Optional[caching.CachedContent]:
+    """
+    Returns a Gemini context cache holding the system prompt and HR policy, so they are not re-sent with every invoice.
+    The cache is shared by all requests for the same policy PDF until it expires, and its name is remembered
+    in the local cache (keyed by the policy hash) so other requests and workers can reuse it.
+    Args:
+        policy_text: The extracted text of the HR reimbursement policy.
+        policy_hash: The SHA-256 hex digest of the policy PDF.
+    Returns:
+        The CachedContent, or None if the policy is too short to cache or caching fails.
+    """
+    cache_key = f"policy-context-cache:{GEMINI_CACHE_MODEL}:{PROMPT_VERSION}:{POLICY_TEXT_VERSION}:{policy_hash}"
+    # Stop handing out a context cache well before Gemini expires it, so in-flight requests can still use it
+    reuse_ttl = int(POLICY_CACHE_TTL.total_seconds()) - 600
+    stored_cache = await llm_cache.get(cache_key)
+    if stored_cache is not None:
+        if stored_cache["name"] is None:
+            return None  # Already known to be too short to cache
+        try:
+            return await asyncio.to_thread(caching.CachedContent.get, stored_cache["name"])
+        except Exception as e:
+            print(f"Warning: Gemini context cache {stored_cache['name']} is no longer available, recreating it: {e}")
+
+    policy_contents = [{"role": "user", "parts": [{"text": f"HR Reimbursement Policy:\n```\n{policy_text}\n```"}]}]
+    try:
+        model = genai.GenerativeModel(GEMINI_CACHE_MODEL, system_instruction=SYSTEM_PROMPT)
+        token_count = await model.count_tokens_async(policy_contents)
+        if token_count.total_tokens < POLICY_CACHE_MIN_TOKENS:
+            await llm_cache.set(cache_key, {"name": None}, ttl=LLM_CACHE_TTL_SECONDS)
+            return None
+        policy_cache = await asyncio.to_thread(
+            caching.CachedContent.create,
+            model=GEMINI_CACHE_MODEL,
+            display_name=policy_hash,
+            system_instruction=SYSTEM_PROMPT,
+            contents=policy_contents,
+            ttl=POLICY_CACHE_TTL
+        )
+        await llm_cache.set(cache_key, {"name": policy_cache.name}, ttl=reuse_ttl)
+        return policy_cache
+    except Exception as e:
+        print(f"Warning: Failed to create Gemini context cache for policy, inlining policy instead: {e}")
+        return None
+
+
+async def lookup_cached_analysis(policy_text: str, invoice_filename: str,
+                                 invoice_text: str) -> Tuple[Optional[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Looks an invoice up in the exact-match and semantic analysis caches.
+    Args:
+        policy_text: The extracted text of the HR reimbursement policy.
+        invoice_filename: The filename of the current invoice.
+        invoice_text: The extracted text of the current invoice.
+    Returns:
+        A tuple of (cached analysis or None, cache keys to pass to store_cached_analysis on a miss).
+    """
+    cache_key = hashlib.sha256(json.dumps(
+        {"m": GEMINI_MODEL, "pv": PROMPT_VERSION, "p": policy_text, "i": invoice_text},
+        sort_keys=True
+    ).encode()).hexdigest()
+    policy_key = hashlib.sha256(json.dumps(
+        {"m": GEMINI_MODEL, "pv": PROMPT_VERSION, "p": policy_text},
+        sort_keys=True
+    ).encode()).hexdigest()
+    cache_keys = {
+        "cache_key": cache_key,
+        "policy_key": policy_key,
+        "fingerprint": _invoice_fingerprint(invoice_text),
+        "embedding": None
+    }
+
+    cached_result = await llm_cache.get(cache_key)
+    if cached_result is None:
+        cache_keys["embedding"] = await embed_text(invoice_text)
+        if cache_keys["embedding"] is not None:
+            cached_result = await semantic_cache.search(
+                policy_key, cache_keys["fingerprint"], cache_keys["embedding"], SEMANTIC_CACHE_THRESHOLD
+            )
+
+    if cached_result is not None:
+        # The same invoice content may arrive under a different filename
+        cached_result["Invoice identifier"] = invoice_filename
+    return cached_result, cache_keys
+
+
+async def store_cached_analysis(cache_keys: Dict[str, Any], analysis_result: Dict[str, Any]) -> None:
+    """
+    Stores a fresh LLM analysis in the exact-match and semantic analysis caches.
+    Args:
+        cache_keys: The cache keys returned by lookup_cached_analysis.
+        analysis_result: The LLM's analysis for the invoice.
+    """
+    await llm_cache.set(cache_keys["cache_key"], analysis_result, ttl=LLM_CACHE_TTL_SECONDS)
+    if cache_keys["embedding"] is not None:
+        await semantic_cache.add(
+            cache_keys["policy_key"], cache_keys["fingerprint"], cache_keys["embedding"],
+            analysis_result, ttl=LLM_CACHE_TTL_SECONDS
+        )
+
+
+async def analyze_invoice_with_llm(policy_text: str, invoice_filename: str, invoice_text: str,
+                                   policy_cache: Optional[caching.CachedContent] = None) -> Dict[str, Any]:
     """
     Analyzes a single invoice against the policy using the LLM.
     Args:
         policy_text: The extracted text of the HR reimbursement policy.
         invoice_filename: The filename of the current invoice.
         invoice_text: The extracted text of the current invoice.
+        policy_cache: Gemini context cache holding the system prompt and policy, if one was created.
     Returns:
         A dictionary containing the LLM's analysis for the invoice.
     Raises:
         HTTPException: If LLM call fails or returns malformed JSON.
     """
-    model = genai.GenerativeModel(GEMINI_MODEL)
-
-    user_prompt = f"""
-HR Reimbursement Policy:
-```
-{policy_text}
-```
-
+    invoice_prompt = f"""
 Invoice to Analyze (Filename: {invoice_filename}):
 ```
 {invoice_text}
 ```
-
-Please analyze this invoice strictly according to the HR Reimbursement Policy provided above and return the analysis in the specified JSON format.
 """
     try:
-        # Make the LLM call with the optimized system prompt and user prompt
-        response = await model.generate_content_async(
-            contents=[
-                {"role": "user", "parts": [{"text": SYSTEM_PROMPT}]},
-                {"role": "model", "parts": [{
-                                                "text": "Understood. I will analyze the invoices based on the provided policy and return the results in the specified JSON format."}]},
-                {"role": "user", "parts": [{"text": user_prompt}]}
-            ],
-            generation_config={"response_mime_type": "application/json"}  # Request JSON output
-        )
+        if policy_cache is not None:
+            # System prompt and policy are already in the context cache, only the invoice is sent
+            model = genai.GenerativeModel.from_cached_content(
+                cached_content=policy_cache, generation_config=GENERATION_CONFIG
+            )
+            user_prompt = invoice_prompt + """
+Please analyze this invoice strictly according to the HR Reimbursement Policy provided earlier and return the analysis in the specified JSON format.
+"""
+        else:
+            model = MODEL
+            user_prompt = f"""
+HR Reimbursement Policy:
+```
+{policy_text}
+```
+{invoice_prompt}
+Please analyze this invoice strictly according to the HR Reimbursement Policy provided above and return the analysis in the specified JSON format.
+"""
+
+        # Make the LLM call; the system prompt and JSON output mode are part of the model configuration
+        response = await model.generate_content_async(user_prompt)
 
         # Access the text part of the response, which should be JSON string
         raw_json_string = response.candidates[0].content.parts[0].text
 
         # Parse the JSON string
-        analysis_result = json.loads(raw_json_string)
+        analysis_result = orjson.loads(raw_json_string)
 
         # Add the invoice identifier from the filename if not already present or for consistency
         if "Invoice identifier" not in analysis_result:
             analysis_result["Invoice identifier"] = invoice_filename
 
         return analysis_result
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         print(f"LLM returned non-JSON or malformed JSON for {invoice_filename}: {raw_json_string}. Error: {e}")
         raise HTTPException(
             status_code=500,
@@ -175,6 +498,294 @@ Please analyze this invoice strictly according to the HR Reimbursement Policy pr
         )
 
 
+async def analyze_invoice_batch_with_llm(policy_text: str, invoices: List[Tuple[str, str]],
+                                         policy_cache: Optional[caching.CachedContent] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Analyzes several invoices against the policy in a single LLM call.
+    Args:
+        policy_text: The extracted text of the HR reimbursement policy.
+        invoices: A list of (invoice filename, invoice text) tuples. Filenames must be unique.
+        policy_cache: Gemini context cache holding the system prompt and policy, if one was created.
+    Returns:
+        A dictionary mapping invoice filename to the LLM's analysis. Invoices the LLM skipped,
+        or answered with an incomplete analysis, are missing from the result.
+    Raises:
+        HTTPException: If LLM call fails or returns malformed JSON.
+    """
+    invoices_prompt = "".join(f"""
+Invoice {number} to Analyze (Filename: {invoice_filename}):
+```
+{invoice_text}
+```
+""" for number, (invoice_filename, invoice_text) in enumerate(invoices, start=1))
+    instructions = f"""
+Please analyze each of these {len(invoices)} invoices independently and strictly according to the HR Reimbursement Policy provided {{where}}.
+Return a JSON object of the form {{{{"invoice_analyses": [...]}}}} containing one analysis per invoice, each in the specified JSON format, with "Invoice identifier" set to the invoice's filename.
+"""
+    try:
+        if policy_cache is not None:
+            # System prompt and policy are already in the context cache, only the invoices are sent
+            model = genai.GenerativeModel.from_cached_content(
+                cached_content=policy_cache, generation_config=GENERATION_CONFIG
+            )
+            user_prompt = invoices_prompt + instructions.format(where="earlier")
+        else:
+            model = MODEL
+            user_prompt = f"""
+HR Reimbursement Policy:
+```
+{policy_text}
+```
+{invoices_prompt}{instructions.format(where="above")}"""
+
+        response = await model.generate_content_async(user_prompt)
+        raw_json_string = response.candidates[0].content.parts[0].text
+        batch_result = orjson.loads(raw_json_string)
+    except orjson.JSONDecodeError as e:
+        print(f"LLM returned non-JSON or malformed JSON for invoice batch: {raw_json_string}. Error: {e}")
+        raise HTTPException(status_code=500, detail="LLM returned malformed JSON for invoice batch.")
+    except Exception as e:
+        print(f"Error during LLM batch analysis: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to analyze invoice batch with LLM: {e}")
+
+    # Keep only complete analyses for invoices that were actually in this batch
+    expected_filenames = {invoice_filename for invoice_filename, _ in invoices}
+    analyses = {}
+    for analysis_result in batch_result.get("invoice_analyses", []) if isinstance(batch_result, dict) else []:
+        if not isinstance(analysis_result, dict) or not ANALYSIS_KEYS.issubset(analysis_result):
+            continue
+        if analysis_result["Invoice identifier"] in expected_filenames:
+            analyses[analysis_result["Invoice identifier"]] = analysis_result
+    return analyses
+
+
+def _make_batches(pending_invoices: List[Tuple[int, str, str, Dict[str, Any]]], policy_text: str,
+                  policy_cache: Optional[caching.CachedContent]) -> List[List[Tuple[int, str, str, Dict[str, Any]]]]:
+    """
+    Groups invoices that need an LLM call into batches for analyze_invoice_batch_with_llm.
+    A batch holds at most INVOICE_BATCH_SIZE invoices and is closed early once its prompt would exceed
+    BATCH_MAX_PROMPT_CHARS (counting the policy unless it is served from the context cache).
+    Args:
+        pending_invoices: A list of (result index, invoice filename, invoice text, cache keys) tuples.
+        policy_text: The extracted text of the HR reimbursement policy.
+        policy_cache: Gemini context cache holding the system prompt and policy, if one was created.
+    Returns:
+        The pending invoices split into batches.
+    """
+    base_chars = 0 if policy_cache is not None else len(policy_text)
+    batches, batch, batch_chars, batch_filenames = [], [], base_chars, set()
+    for pending in pending_invoices:
+        invoice_filename, invoice_text = pending[1], pending[2]
+        if batch and (len(batch) >= INVOICE_BATCH_SIZE
+                      or batch_chars + len(invoice_text) > BATCH_MAX_PROMPT_CHARS
+                      or invoice_filename in batch_filenames):
+            batches.append(batch)
+            batch, batch_chars, batch_filenames = [], base_chars, set()
+        batch.append(pending)
+        batch_chars += len(invoice_text)
+        batch_filenames.add(invoice_filename)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _declined(invoice_filename: str, reason: str) -> Dict[str, Any]:
+    """
+    Builds a "Declined" analysis for an invoice that was not (or could not be) analyzed by the LLM,
+    using the same keys as the LLM's analyses.
+    Args:
+        invoice_filename: The filename of the invoice.
+        reason: Why the invoice was declined.
+    Returns:
+        A dictionary in the InvoiceAnalysis (alias) format.
+    """
+    return {
+        "Invoice identifier": invoice_filename,
+        "Reimbursement Status": "Declined",
+        "Reimbursable Amount": 0,
+        "Reason": reason
+    }
+
+
+async def _prepare_one(invoice_filename: str, invoice_bytes: bytes,
+                       policy_text: str) -> Tuple[Optional[Tuple[str, Dict[str, Any]]], str, Dict[str, Any]]:
+    """
+    Extracts text from a single invoice and looks it up in the analysis caches.
+    Any failure is converted into a "Declined" result so one bad invoice does not abort the batch.
+    Args:
+        invoice_filename: The filename of the invoice PDF.
+        invoice_bytes: The raw contents of the invoice PDF.
+        policy_text: The extracted text of the HR reimbursement policy.
+    Returns:
+        A tuple of ((reimbursement status, analysis result) or None if the invoice still needs an LLM call,
+        invoice text, cache keys).
+    """
+    try:
+        # PDF parsing is CPU-bound, so it runs in the process pool instead of on the event loop
+        invoice_text = await asyncio.get_running_loop().run_in_executor(
+            PDF_POOL, extract_text_from_pdf, invoice_filename, invoice_bytes
+        )
+        if not invoice_text.strip():
+            print(f"Warning: Could not extract text from invoice {invoice_filename}. Skipping analysis.")
+            analysis_result = _declined(invoice_filename, "Could not extract readable text from this invoice PDF.")
+            return ("Declined", analysis_result), invoice_text, {}
+
+        # Obvious policy violations are declined by the rule engine without an LLM call
+        rule_reason = match_decline_rule(invoice_text)
+        if rule_reason is not None:
+            analysis_result = _declined(invoice_filename, f"{rule_reason} (auto-rule)")
+            return ("Declined", analysis_result), invoice_text, {}
+
+        cached_result, cache_keys = await lookup_cached_analysis(policy_text, invoice_filename, invoice_text)
+        if cached_result is not None:
+            return (cached_result.get("Reimbursement Status"), cached_result), invoice_text, cache_keys
+        return None, invoice_text, cache_keys
+
+    except Exception as e:
+        print(f"Error processing individual invoice {invoice_filename}: {e}")
+        analysis_result = _declined(invoice_filename, f"Processing error: {str(e)}")
+        return ("Declined", analysis_result), "", {}  # Count as declined if processing failed
+
+
+async def _process_one(invoice_filename: str, invoice_text: str, cache_keys: Dict[str, Any], policy_text: str,
+                       policy_cache: Optional[caching.CachedContent] = None) -> Tuple[str, Dict[str, Any]]:
+    """
+    Analyzes a single invoice with its own LLM call and caches the result.
+    Any failure is converted into a "Declined" result so one bad invoice does not abort the batch.
+    Args:
+        invoice_filename: The filename of the invoice PDF.
+        invoice_text: The extracted text of the invoice.
+        cache_keys: The cache keys returned by lookup_cached_analysis.
+        policy_text: The extracted text of the HR reimbursement policy.
+        policy_cache: Gemini context cache holding the system prompt and policy, if one was created.
+    Returns:
+        A tuple of (reimbursement status, analysis result dictionary).
+    """
+    try:
+        async with LLM_SEMAPHORE:
+            invoice_analysis = await analyze_invoice_with_llm(
+                policy_text=policy_text,
+                invoice_filename=invoice_filename,
+                invoice_text=invoice_text,
+                policy_cache=policy_cache
+            )
+        await store_cached_analysis(cache_keys, invoice_analysis)
+        return invoice_analysis.get("Reimbursement Status"), invoice_analysis
+
+    except Exception as e:
+        print(f"Error processing individual invoice {invoice_filename}: {e}")
+        analysis_result = _declined(invoice_filename, f"Processing error: {str(e)}")
+        return "Declined", analysis_result  # Count as declined if processing failed
+
+
+async def _process_batch(batch: List[Tuple[int, str, str, Dict[str, Any]]], policy_text: str,
+                         policy_cache: Optional[caching.CachedContent] = None) -> List[Tuple[str, Dict[str, Any]]]:
+    """
+    Analyzes a batch of invoices with one LLM call, falling back to per-invoice calls
+    for any invoice the batched response did not cover.
+    Args:
+        batch: A list of (result index, invoice filename, invoice text, cache keys) tuples.
+        policy_text: The extracted text of the HR reimbursement policy.
+        policy_cache: Gemini context cache holding the system prompt and policy, if one was created.
+    Returns:
+        A list of (reimbursement status, analysis result dictionary) tuples, in batch order.
+    """
+    batch_analyses = {}
+    if len(batch) > 1:
+        try:
+            async with LLM_SEMAPHORE:
+                batch_analyses = await analyze_invoice_batch_with_llm(
+                    policy_text=policy_text,
+                    invoices=[(invoice_filename, invoice_text) for _, invoice_filename, invoice_text, _ in batch],
+                    policy_cache=policy_cache
+                )
+        except Exception as e:
+            print(f"Batched analysis failed, falling back to per-invoice calls: {e}")
+
+    async def _finish(invoice_filename: str, invoice_text: str, cache_keys: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+        invoice_analysis = batch_analyses.get(invoice_filename)
+        if invoice_analysis is None:
+            return await _process_one(invoice_filename, invoice_text, cache_keys, policy_text, policy_cache)
+        await store_cached_analysis(cache_keys, invoice_analysis)
+        return invoice_analysis.get("Reimbursement Status"), invoice_analysis
+
+    return await asyncio.gather(
+        *[_finish(invoice_filename, invoice_text, cache_keys) for _, invoice_filename, invoice_text, cache_keys in batch]
+    )
+
+
+async def stream_invoice_analyses(invoice_files: List[Tuple[str, bytes]], policy_text: str,
+                                  policy_hash: str) -> AsyncIterator[bytes]:
+    """
+    Analyzes invoices against the policy, yielding one NDJSON line per invoice as soon as its analysis is ready,
+    followed by a final summary line with the overall status of the batch.
+    Args:
+        invoice_files: A list of (invoice filename, invoice PDF bytes) tuples.
+        policy_text: The extracted text of the HR reimbursement policy.
+        policy_hash: The SHA-256 hex digest of the policy PDF.
+    Yields:
+        NDJSON lines: invoice analyses, then {"overall_status": ...}.
+        An unexpected error ends the stream with a {"detail": ...} line.
+    """
+    analyzed_count = 0
+    fully_reimbursed_count = 0
+    partially_reimbursed_count = 0
+    declined_count = 0
+
+    def _record(status: str, analysis_result: Dict[str, Any]) -> bytes:
+        nonlocal analyzed_count, fully_reimbursed_count, partially_reimbursed_count, declined_count
+        # Update counts for overall status
+        analyzed_count += 1
+        if status == "Fully Reimbursed":
+            fully_reimbursed_count += 1
+        elif status == "Partially Reimbursed":
+            partially_reimbursed_count += 1
+        elif status == "Declined":
+            declined_count += 1
+        return orjson.dumps(analysis_result) + b"\n"
+
+    try:
+        # Extract invoice text and check the analysis caches concurrently; cached results are sent right away
+        prepared = await asyncio.gather(
+            *[_prepare_one(invoice_filename, invoice_bytes, policy_text)
+              for invoice_filename, invoice_bytes in invoice_files]
+        )
+        pending_invoices = []
+        for index, (result, invoice_text, cache_keys) in enumerate(prepared):
+            if result is None:
+                pending_invoices.append((index, invoice_files[index][0], invoice_text, cache_keys))
+            else:
+                yield _record(*result)
+
+        # Analyze the remaining invoices using LLM in concurrent batches, sharing one cached copy
+        # of the policy when possible, and send each batch's results as soon as it finishes
+        policy_cache = None
+        if len(pending_invoices) > 1:
+            policy_cache = await get_policy_cache(policy_text, policy_hash)
+        batches = _make_batches(pending_invoices, policy_text, policy_cache)
+        for batch_results in asyncio.as_completed(
+                [_process_batch(batch, policy_text, policy_cache) for batch in batches]):
+            for result in await batch_results:
+                yield _record(*result)
+
+    except Exception as e:
+        # Headers are already sent, so report the error in-band
+        print(f"An unhandled error occurred while streaming analyses: {e}")
+        yield orjson.dumps({"detail": f"Internal server error: {e}"}) + b"\n"
+        return
+
+    # Determine overall status
+    overall_status = "No Invoices Processed"
+    if analyzed_count > 0:
+        if fully_reimbursed_count == analyzed_count:
+            overall_status = "All Fully Reimbursed"
+        elif declined_count == analyzed_count:
+            overall_status = "All Declined"
+        else:
+            overall_status = "Mixed Status"  # Any combination of statuses
+    yield orjson.dumps({"overall_status": overall_status}) + b"\n"
+
+
 class ReimbursementStatus(str, Enum):
     fully = "Fully Reimbursed"
     partially = "Partially Reimbursed"
@@ -186,9 +797,9 @@ class InvoiceAnalysis(BaseModel):
     reimbursable_amount: int = Field(..., alias="Reimbursable Amount", description="Amount eligible for reimbursement")
     reason: str = Field(..., alias="Reason", description="Explanation derived from HR policy")
 
-    class Config:
-        allow_population_by_field_name = True  # This helps FastAPI correctly use aliases
-        schema_extra = {
+    model_config = ConfigDict(
+        populate_by_name=True,  # Accept both field names and aliases; serialization uses the aliases
+        json_schema_extra={
             "example": {
                 "Invoice identifier": "invoice123.pdf",
                 "Reimbursement Status": "Partially Reimbursed",
@@ -196,14 +807,19 @@ class InvoiceAnalysis(BaseModel):
                 "Reason": "Meal limit exceeded. Only $150 of the $250 was eligible under policy clause 3.2."
             }
         }
-
-class InvoiceAnalysisResponse(BaseModel):
-    overall_status: str
-    invoice_analyses: List[InvoiceAnalysis]
+    )
 
 # --- FastAPI Endpoint ---
 
-@app.post("/analyze_invoices/", response_model=InvoiceAnalysisResponse)
+@app.post(
+    "/analyze_invoices/",
+    response_class=StreamingResponse,
+    responses={200: {
+        "description": "NDJSON stream: one InvoiceAnalysis object per line as each invoice is analyzed, "
+                       "followed by a final line with the batch's overall_status.",
+        "content": {"application/x-ndjson": {}}
+    }}
+)
 async def analyze_invoices(
         policy_file: UploadFile = File(..., description="PDF file containing the HR Reimbursement Policy."),
         invoice_zip: UploadFile = File(..., description="ZIP file containing one or more employee invoice PDF files.")
@@ -217,109 +833,35 @@ async def analyze_invoices(
         invoice_zip (UploadFile): A ZIP file containing employee invoice PDF files.
 
     Returns:
-        JSONResponse: A JSON object detailing the analysis for each invoice,
-                      including an overall status for the batch.
+        StreamingResponse: An NDJSON stream with one analysis per invoice, in completion order,
+                           followed by a summary line with the overall status for the batch.
     """
-    temp_dir = None
     try:
-        # 1. Create a temporary directory for file storage
-        temp_dir = tempfile.mkdtemp()
-        policy_path = os.path.join(temp_dir, policy_file.filename)
-        invoice_zip_path = os.path.join(temp_dir, invoice_zip.filename)
-        extracted_invoices_dir = os.path.join(temp_dir, "invoices")
-        os.makedirs(extracted_invoices_dir, exist_ok=True)
-
-        # 2. Save uploaded files
-        with open(policy_path, "wb") as buffer:
-            shutil.copyfileobj(policy_file.file, buffer)
-        with open(invoice_zip_path, "wb") as buffer:
-            shutil.copyfileobj(invoice_zip.file, buffer)
-
-        # 3. Extract HR Policy text
+        # 1. Read the policy upload into memory; nothing is written to disk
         if not policy_file.filename.lower().endswith(".pdf"):
             raise HTTPException(status_code=400, detail="HR Policy file must be a PDF.")
-        policy_text = extract_text_from_pdf(policy_path)
+        policy_bytes = await policy_file.read()
+
+        # 2. Extract HR Policy text, reusing the cached text when the same policy PDF was seen before
+        policy_hash = hashlib.sha256(policy_bytes).hexdigest()
+        policy_text = await get_policy_text(policy_file.filename, policy_bytes, policy_hash)
         if not policy_text.strip():
             raise HTTPException(status_code=400,
                                 detail="Could not extract text from HR Policy PDF. It might be empty or malformed.")
 
-        # 4. Extract invoices from ZIP
-        invoice_files = []
-        with zipfile.ZipFile(invoice_zip_path, 'r') as zip_ref:
-            for member in zip_ref.namelist():
-                # Only process PDF files within the zip
-                if member.lower().endswith(".pdf") and not member.startswith(
-                        '__MACOSX/'):  # Ignore macOS specific files
-                    member_path = zip_ref.extract(member, extracted_invoices_dir)
-                    invoice_files.append(member_path)
+        # 3. Read invoices straight out of the uploaded ZIP without copying the archive first
+        #    (decompression runs off the event loop)
+        await invoice_zip.seek(0)
+        invoice_files = await asyncio.to_thread(read_invoices_from_zip, invoice_zip.file)
 
         if not invoice_files:
             raise HTTPException(status_code=400, detail="No PDF invoice files found in the provided ZIP archive.")
 
-        # 5. Analyze each invoice using LLM
-        analysis_results = []
-        fully_reimbursed_count = 0
-        partially_reimbursed_count = 0
-        declined_count = 0
-
-        for invoice_path in invoice_files:
-            invoice_filename = os.path.basename(invoice_path)
-            try:
-                invoice_text = extract_text_from_pdf(invoice_path)
-                if not invoice_text.strip():
-                    print(f"Warning: Could not extract text from invoice {invoice_filename}. Skipping analysis.")
-                    analysis_result = {
-                        "invoice_identifier": invoice_filename,
-                        "reimbursement_status": "Declined",
-                        "reimbursable_amount": 0,
-                        "reason": "Could not extract readable text from this invoice PDF."
-                    }
-                    declined_count += 1
-                    analysis_results.append(analysis_result)
-                    continue  # Skip to next invoice
-
-                # Call LLM for analysis
-                invoice_analysis = await analyze_invoice_with_llm(
-                    policy_text=policy_text,
-                    invoice_filename=invoice_filename,
-                    invoice_text=invoice_text
-                )
-                analysis_results.append(invoice_analysis)
-
-                # Update counts for overall status
-                status = invoice_analysis.get("Reimbursement Status")
-                if status == "Fully Reimbursed":
-                    fully_reimbursed_count += 1
-                elif status == "Partially Reimbursed":
-                    partially_reimbursed_count += 1
-                elif status == "Declined":
-                    declined_count += 1
-
-            except Exception as e:
-                print(f"Error processing individual invoice {invoice_filename}: {e}")
-                analysis_result = {
-                    "Invoice identifier": invoice_filename,
-                    "Reimbursement Status": "Declined",
-                    "Reimbursable Amount": 0,
-                    "Reason": f"Processing error: {str(e)}"
-                }
-                declined_count += 1  # Count as declined if processing failed
-                analysis_results.append(analysis_result)
-
-        # Determine overall status
-        overall_status = "No Invoices Processed"
-        if len(analysis_results) > 0:
-            if fully_reimbursed_count == len(analysis_results):
-                overall_status = "All Fully Reimbursed"
-            elif declined_count == len(analysis_results):
-                overall_status = "All Declined"
-            else:
-                overall_status = "Mixed Status"  # Any combination of statuses
-
-        return JSONResponse(content={
-            "overall_status": overall_status,
-            "invoice_analyses": analysis_results
-        })
+        # 4. Analyze invoices, streaming each result back as soon as it is ready
+        return StreamingResponse(
+            stream_invoice_analyses(invoice_files, policy_text, policy_hash),
+            media_type="application/x-ndjson"
+        )
 
     except HTTPException as e:
         # Re-raise FastAPI HTTP exceptions directly
@@ -328,13 +870,12 @@ async def analyze_invoices(
         # Catch any other unexpected errors
         print(f"An unhandled error occurred: {e}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
-    finally:
-        # 6. Clean up temporary files
-        if temp_dir and os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
-            print(f"Cleaned up temporary directory: {temp_dir}")
 
 
 # This block allows you to run the FastAPI app directly using 'python main.py'
+# WEB_CONCURRENCY sets the number of worker processes (defaults to one per CPU core).
+# DEV_RELOAD=1 enables the file-watching auto-reloader for local development; it only works with a single worker.
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="127.0.0.1", port=8000, reload=True)
+    RELOAD = os.getenv("DEV_RELOAD", "0") == "1"
+    WORKERS = 1 if RELOAD else int(os.getenv("WEB_CONCURRENCY", os.cpu_count()))
+    uvicorn.run("main:app", host="127.0.0.1", port=8000, reload=RELOAD, workers=WORKERS)